@@ -3,6 +3,8 @@
 from __future__ import annotations
 
 try:
+    import asyncio
+    import io
     from pathlib import Path
     from typing import Any
 
@@ -49,7 +51,10 @@ def display_kcell(
     display_type = display_type or config.display_type
     match display_type:
         case "widget":
-            lw = LayoutWidget(cell=cell_dup, layer_properties=lyrdb)
+            # The cell is deleted below, build the layer groups while it exists.
+            lw = LayoutWidget(
+                cell=cell_dup, layer_properties=lyrdb, lazy_layer_groups=False
+            )
             display(lw.widget)  # type: ignore[no-untyped-call,unused-ignore]
         case "image":
             lipi = LayoutIPImage(cell=cell_dup, layer_properties=lyrdb)
@@ -58,6 +63,8 @@ def display_kcell(
 
 
 widgets: list[LayoutImage | LayoutIPImage] = []
+# KLayout starts a drag once the mouse moved more than this many pixels.
+_DRAG_THRESHOLD = 5
 
 
 class LayoutImage:
@@ -124,10 +131,61 @@ class LayoutWidget:
         layer_properties: Path | str | None = None,
         hide_unused_layers: bool = True,
         with_layer_selector: bool = True,
+        lazy_layer_groups: bool = True,
+        image_format: Literal["png", "jpeg"] = "png",
     ):
+        """Interactive jupyter widget of a cell.
+
+        Args:
+            cell: The cell to display.
+            layer_properties: Optional path for the layer_properties klayout file
+                (lyp).
+            hide_unused_layers: Hide layers without shapes in the layer selector.
+            with_layer_selector: Show the layer and cell selector tabs.
+            lazy_layer_groups: Only build the toggles of a layer group once it is
+                opened. Disable if the cell is deleted while the widget is shown.
+            image_format: Format the frames are sent to the frontend in. KLayout
+                only renders PNG, so "jpeg" transcodes every frame with pillow
+                (which must be installed). This costs more CPU per frame than PNG
+                but sends smaller (lossy) images, which can help on slow
+                connections to a remote kernel.
+        """
         self.debug = Output()
+        self.image_format = image_format
 
         self.hide_unused_layers = hide_unused_layers
+        self.lazy_layer_groups = lazy_layer_groups
+
+        self._wheel_timer: asyncio.TimerHandle | None = None
+        self._wheel_accum = 0
+        self._wheel_pos = kdb.DPoint()
+        self._wheel_buttons = 0
+
+        self._refresh_timer: asyncio.TimerHandle | None = None
+        self._refresh_pending = False
+        self._last_pixels: lay.PixelBuffer | None = None
+        # The kernel's event loop. Deferred work (wheel bursts, refreshes) is run
+        # on it, as the LayoutView must only be used from one thread.
+        try:
+            self._loop: asyncio.AbstractEventLoop | None = asyncio.get_running_loop()
+        except RuntimeError:
+            self._loop = None
+        self._bbox_empty_cache: dict[int, dict[int, bool]] = {}
+        self._mod_lut = self._build_modifier_lut()
+        self._needs_enter = False
+        self._entered = False
+        self._interacting = False
+        self._press_pos: tuple[float, float] | None = None
+        self._drag_buttons = (
+            lay.ButtonState.LeftButton
+            | lay.ButtonState.RightButton
+            | lay.ButtonState.MidButton
+        )
+        self._mouse_dispatch = {
+            "mousedown": self._mouse_press,
+            "mouseup": self._mouse_release,
+            "mousemove": self._mouse_move,
+        }
 
         self.layout_view = lay.LayoutView()
         self.layout_view.show_layout(cell.kcl.layout, False)
@@ -138,9 +196,10 @@ class LayoutWidget:
                 self.layer_properties = self.layer_properties
                 self.layout_view.load_layer_props(str(self.layer_properties))
         self.show_cell(cell._kdb_cell)
-        png_data = self.layout_view.get_screenshot_pixels().to_png_data()
 
-        self.image = Image(value=png_data, format="png")
+        # Fix the displayed size, frames are rendered at lower resolution during
+        # drags. The first frame is rendered by the refresh below.
+        self.image = Image(value=b"", format=image_format, width=800, height=600)
         self.refresh()
         scroll_event = Event(source=self.image, watched_events=["wheel"], wait=10)
         scroll_event.on_dom_event(self.on_scroll)
@@ -190,8 +249,14 @@ class LayoutWidget:
         )
 
     def show_cell(self, cell: kdb.Cell) -> None:
+        # The shown layout is live and can have been modified since the cell was
+        # last shown. KLayout has no notification for layout modifications, so the
+        # empty layer probes are only reused while the cell stays shown (between
+        # the layer selector and its lazily built layer groups).
+        self._bbox_empty_cache.pop(cell.cell_index(), None)
         self.layout_view.active_cellview().cell_index = cell.cell_index()
         self.layout_view.max_hier()
+        self._interacting = False
         self.layout_view.resize(800, 600)
         self.layout_view.add_missing_layers()
         self.layout_view.zoom_fit()
@@ -203,17 +268,24 @@ class LayoutWidget:
             else button.default_color
         )
 
-        logger.info("button toggle")
-        for props in self.layout_view.each_layer():
-            if props == button.layer_props:
-                props.visible = not props.visible
-                props.name = button.name
-                button.layer_props = props
-                break
+        logger.debug("button toggle {}", button.name)
+        props = button.layer_props
+        props.visible = not props.visible
+        props.name = button.name
         self.refresh()
 
-    def build_layer_toggle(self, prop_iter: lay.LayerPropertiesIterator) -> HBox | None:
+    def build_layer_toggle(
+        self, prop_iter: lay.LayerPropertiesIterator, cell: kdb.Cell | None = None
+    ) -> HBox | None:
         props = prop_iter.current()
+        if cell is None:
+            cell = self.layout_view.active_cellview().cell
+        if props.has_children():
+            if not self._has_content(cell, prop_iter):
+                return None
+        elif self._layer_empty(cell, props.layer_index()):
+            return None
+
         layer_color = f"#{props.eff_fill_color():06x}"
         Layout(
             width="5px",
@@ -246,23 +318,16 @@ class LayoutWidget:
         image_event.on_dom_event(on_layer_click)
 
         if props.has_children():
-            prop_iter = prop_iter.down_first_child()
-            n_children = prop_iter.num_siblings()
-            children = []
-            for _i in range(n_children):
-                prop_iter = prop_iter.next()
-                _layer_toggle = self.build_layer_toggle(prop_iter)
-                if _layer_toggle is not None:
-                    children.append(_layer_toggle)
-
-            if not children:
-                return None
-            layer_label = Accordion([VBox(children)], titles=(props.name,))
-
+            if self.lazy_layer_groups:
+                # The children are only built once the accordion is opened.
+                layer_label = Accordion([VBox([])], titles=(props.name,))
+                layer_label._kf_prop_iter = prop_iter.dup()
+                layer_label._kf_cell = cell
+                layer_label.observe(self._expand_accordion, "selected_index")
+            else:
+                children = self._build_layer_toggles(prop_iter.first_child(), cell)
+                layer_label = Accordion([VBox(children)], titles=(props.name,))
         else:
-            cell = self.layout_view.active_cellview().cell
-            if cell.bbox(prop_iter.current().layer_index()).empty():
-                return None
             layer_label = (
                 Label(props.name)
                 if props.name
@@ -271,6 +336,60 @@ class LayoutWidget:
 
         return HBox([Box([image]), layer_label])
 
+    def _expand_accordion(self, change: dict[str, Any]) -> None:
+        accordion = change["owner"]
+        vbox = accordion.children[0]
+        if change["new"] is None or vbox.children:
+            return
+        if accordion._kf_cell.destroyed():
+            # The cell was deleted after the selector was built.
+            vbox.children = [Label("The cell of this layer group was deleted.")]
+            return
+        vbox.children = self._build_layer_toggles(
+            accordion._kf_prop_iter.first_child(), accordion._kf_cell
+        )
+
+    def _build_layer_toggles(
+        self, prop_iter: lay.LayerPropertiesIterator, cell: kdb.Cell
+    ) -> list[HBox]:
+        """Build the toggles of a layer and its following siblings."""
+        layer_toggles = []
+        while not prop_iter.at_end():
+            if layer_toggle := self.build_layer_toggle(prop_iter, cell):
+                layer_toggles.append(layer_toggle)
+            prop_iter.next_sibling(1)
+        return layer_toggles
+
+    def _has_content(
+        self, cell: kdb.Cell, prop_iter: lay.LayerPropertiesIterator
+    ) -> bool:
+        """Check whether any layer below a layer group has shapes in the cell."""
+        # One sibling iterator per level of the group's subtree.
+        stack = [prop_iter.first_child()]
+        while stack:
+            child_iter = stack[-1]
+            if child_iter.at_end():
+                stack.pop()
+                continue
+            props = child_iter.current()
+            if props.has_children():
+                stack.append(child_iter.first_child())
+            elif not self._layer_empty(cell, props.layer_index()):
+                return True
+            child_iter.next_sibling(1)
+        return False
+
+    def _layer_empty(self, cell: kdb.Cell, layer_index: int) -> bool:
+        if layer_index < 0:
+            # The layer properties refer to a layer which isn't in the layout.
+            return True
+        cache = self._bbox_empty_cache.setdefault(cell.cell_index(), {})
+        empty = cache.get(layer_index)
+        if empty is None:
+            empty = cell.bbox(layer_index).empty()
+            cache[layer_index] = empty
+        return empty
+
     def build_modes(self, max_height: float) -> VBox:
         def clear(event: Event) -> None:
             self.layout_view.clear_annotations()
@@ -299,19 +418,29 @@ class LayoutWidget:
         return VBox(children=(clear_button, zoom_button, mode_label, tb))
 
     def build_cell_selector(self, cell: kdb.Cell) -> Node:
+        return self._build_cell_node(cell.layout(), cell.cell_index(), {})
+
+    def _build_cell_node(
+        self,
+        layout: kdb.Layout,
+        cell_index: int,
+        cache: dict[int, tuple[str, tuple[int, ...]]],
+    ) -> Node:
+        # A Node can only appear once in the tree, so only the lookups of cells
+        # which are referenced multiple times are cached, not the Nodes.
+        entry = cache.get(cell_index)
+        if entry is None:
+            cell = layout.cell(cell_index)
+            entry = (cell.name, tuple(cell.each_child_cell()))
+            cache[cell_index] = entry
+        name, child_indexes = entry
+
         child_cells = [
-            self.build_cell_selector(
-                self.layout_view.active_cellview().layout().cell(_cell)
-            )
-            for _cell in cell.each_child_cell()
+            self._build_cell_node(layout, ci, cache) for ci in child_indexes
         ]
-
-        node = Node(cell.name, show_icon=False)
+        node = Node(name, child_cells, show_icon=False)
         node.observe(self.on_select_cell, "selected")
 
-        for cc in child_cells:
-            node.add_node(cc)
-
         return node
 
     def build_selector(self, max_height: float) -> Tab:
@@ -321,13 +450,9 @@ class LayoutWidget:
             max_height: Maximum height to set for the widget (likely the height of the
                 pixel buffer).
         """
-        all_boxes = []
-
-        prop_iter = self.layout_view.begin_layers()
-        while not prop_iter.at_end():
-            if layer_toggle := self.build_layer_toggle(prop_iter):
-                all_boxes.append(layer_toggle)
-            prop_iter.next()
+        all_boxes = self._build_layer_toggles(
+            self.layout_view.begin_layers(), self.layout_view.active_cellview().cell
+        )
 
         layout = Layout(
             max_height=f"{max_height}px", overflow_y="auto", display="block"
@@ -356,40 +481,86 @@ class LayoutWidget:
             layer_properties: Optional path for the layer_properties klayout file (lyp).
         """
         self.layout_view.load_layout(filepath)
+        self._bbox_empty_cache.clear()
         self.layout_view.max_hier()
         if layer_properties:
             self.layout_view.load_layer_props(layer_properties)
 
     def refresh(self) -> None:
+        """Update the image, rendering at most once per frame.
+
+        If a frame was rendered recently, the update is deferred until the frame
+        is over and only the latest state is rendered. Without a running event
+        loop every refresh is rendered immediately.
+        """
+        if self._loop is None or self._loop.is_closed():
+            self._do_refresh()
+            return
+        if self._refresh_timer is not None:
+            self._refresh_pending = True
+            return
+        # Schedule the frame end before rendering, rendering can call refresh
+        # again through `on_image_updated_event`.
+        self._refresh_timer = self._loop.call_later(0.033, self._refresh_tick)
+        self._do_refresh()
+
+    def _refresh_tick(self) -> None:
+        if self._refresh_pending and self._loop is not None:
+            self._refresh_pending = False
+            self._refresh_timer = self._loop.call_later(0.033, self._refresh_tick)
+            self._do_refresh()
+        else:
+            self._refresh_timer = None
+
+    def _do_refresh(self) -> None:
         self.layout_view.timer()
-        png_data = self.layout_view.get_screenshot_pixels().to_png_data()
-        self.image.value = png_data
-        self.layout_view.timer()
+        pixels = self.layout_view.get_screenshot_pixels()
+        # Only encode and send the image if something on screen changed.
+        if self._last_pixels is None or pixels != self._last_pixels:
+            self._last_pixels = pixels
+            self.image.value = self._encode(pixels)
+
+    def _encode(self, pixels: lay.PixelBuffer) -> bytes:
+        png_data = pixels.to_png_data()
+        if self.image_format == "png":
+            return png_data
+        # KLayout can only export PNG, transcode to the smaller (lossy) JPEG.
+        from PIL import Image as PILImage
+
+        buf = io.BytesIO()
+        PILImage.open(io.BytesIO(png_data)).convert("RGB").save(
+            buf, format="JPEG", quality=75
+        )
+        return buf.getvalue()
+
+    @staticmethod
+    def _build_modifier_lut() -> tuple[int, ...]:
+        """Map packed `shift|alt|ctrl|buttons` bits to KLayout button states."""
+        lut = []
+        for packed in range(64):
+            buttons = 0
+            if packed & 32:
+                buttons |= lay.ButtonState.ShiftKey
+            if packed & 16:
+                buttons |= lay.ButtonState.AltKey
+            if packed & 8:
+                buttons |= lay.ButtonState.ControlKey
+            if packed & 1:
+                buttons |= lay.ButtonState.LeftButton
+            if packed & 2:
+                buttons |= lay.ButtonState.RightButton
+            if packed & 4:
+                buttons |= lay.ButtonState.MidButton
+            lut.append(buttons)
+        return tuple(lut)
 
     def _get_modifier_buttons(self, event: Event) -> int:
-        shift = event["shiftKey"]
-        alt = event["altKey"]
-        ctrl = event["ctrlKey"]
-        # meta = event["metaKey"]
-
-        mouse_buttons = event["buttons"]
-
-        buttons = 0
-        if shift:
-            buttons |= lay.ButtonState.ShiftKey
-        if alt:
-            buttons |= lay.ButtonState.AltKey
-        if ctrl:
-            buttons |= lay.ButtonState.ControlKey
-
-        if mouse_buttons & 1:
-            buttons |= lay.ButtonState.LeftButton
-        if mouse_buttons & 2:
-            buttons |= lay.ButtonState.RightButton
-        if mouse_buttons & 4:
-            buttons |= lay.ButtonState.MidButton
-
-        return buttons
+        return self._mod_lut[
+            (event["shiftKey"] << 5)
+            | (event["altKey"] << 4)
+            | (event["ctrlKey"] << 3)
+            | (event["buttons"] & 7)
+        ]
 
     def on_select_cell(self, event: Event) -> None:
         self.show_cell(
@@ -398,12 +569,9 @@ class LayoutWidget:
 
         self.layout_view.viewport_height()
 
-        all_boxes = []
-        prop_iter = self.layout_view.begin_layers()
-        while not prop_iter.at_end():
-            if layer_toggle := self.build_layer_toggle(prop_iter):
-                all_boxes.append(layer_toggle)
-            prop_iter.next()
+        all_boxes = self._build_layer_toggles(
+            self.layout_view.begin_layers(), self.layout_view.active_cellview().cell
+        )
 
         tabs = self.widget.right_sidebar
         vbox = tabs.children[0]
@@ -411,42 +579,103 @@ class LayoutWidget:
         self.refresh()
 
     def on_scroll(self, event: Event) -> None:
-        self.layout_view.timer()
-        delta = int(event["deltaY"])
-        x = event["relativeX"]
-        y = event["relativeY"]
-        buttons = self._get_modifier_buttons(event)
-        self.layout_view.send_wheel_event(-delta, False, kdb.DPoint(x, y), buttons)
+        # Accumulate bursts of wheel events (e.g. from a trackpad) and only send
+        # the summed delta once the burst is over.
+        self._wheel_accum += -int(event["deltaY"])
+        self._wheel_pos = self._view_point(event["relativeX"], event["relativeY"])
+        self._wheel_buttons = self._get_modifier_buttons(event)
+        if self._loop is None or self._loop.is_closed():
+            self._flush_wheel()
+            return
+        if self._wheel_timer is not None:
+            self._wheel_timer.cancel()
+        self._wheel_timer = self._loop.call_later(0.05, self._flush_wheel)
+
+    def _flush_wheel(self) -> None:
+        delta = self._wheel_accum
+        self._wheel_accum = 0
+        self._wheel_timer = None
+        if delta == 0:
+            return
+        self._send_pending_enter()
+        self.layout_view.send_wheel_event(
+            delta,
+            False,
+            self._wheel_pos,
+            self._wheel_buttons,
+        )
         self.refresh()
 
     def on_mouse(self, event: Event) -> None:
-        self.layout_view.timer()
-        x = event["relativeX"]
-        y = event["relativeY"]
-        buttons = self._get_modifier_buttons(event)
-
-        match event["event"]:
-            case "mousedown":
-                self.layout_view.send_mouse_press_event(
-                    kdb.DPoint(float(x), float(y)), buttons
-                )
-            case "mouseup":
-                self.layout_view.send_mouse_release_event(
-                    kdb.DPoint(float(x), float(y)), buttons
-                )
-            case "mousemove":
-                self.layout_view.send_mouse_move_event(
-                    kdb.DPoint(float(x), float(y)), buttons
-                )
+        self._send_pending_enter()
+        handler = self._mouse_dispatch.get(event["event"])
+        if handler is not None:
+            handler(
+                event["relativeX"],
+                event["relativeY"],
+                self._get_modifier_buttons(event),
+            )
         self.refresh()
-        self.layout_view.timer()
+
+    def _mouse_press(self, x: float, y: float, buttons: int) -> None:
+        self._press_pos = (x, y)
+        self.layout_view.send_mouse_press_event(self._view_point(x, y), buttons)
+
+    def _mouse_release(self, x: float, y: float, buttons: int) -> None:
+        self.layout_view.send_mouse_release_event(self._view_point(x, y), buttons)
+        self._press_pos = None
+        self._set_interacting(False)
+
+    def _mouse_move(self, x: float, y: float, buttons: int) -> None:
+        self.layout_view.send_mouse_move_event(self._view_point(x, y), buttons)
+        if (
+            not self._interacting
+            and self._press_pos is not None
+            and buttons & self._drag_buttons
+            and max(abs(x - self._press_pos[0]), abs(y - self._press_pos[1]))
+            > _DRAG_THRESHOLD
+        ):
+            # KLayout has started the drag at full resolution with this move, only
+            # the following moves of the drag are rendered at lower resolution.
+            # Switching earlier would mix coordinate scales in KLayout's drag
+            # detection and turn clicks into drags.
+            self._set_interacting(True)
+
+    def _set_interacting(self, interacting: bool) -> None:
+        """Switch between half resolution rendering (during drags) and full."""
+        if interacting == self._interacting:
+            return
+        self._interacting = interacting
+        if interacting:
+            self.layout_view.resize(400, 300)
+        else:
+            self.layout_view.resize(800, 600)
+
+    def _view_point(self, x: float, y: float) -> kdb.DPoint:
+        """Convert image coordinates to coordinates of the (resized) view."""
+        if self._interacting:
+            return kdb.DPoint(x / 2, y / 2)
+        return kdb.DPoint(float(x), float(y))
 
     def on_mouse_enter(self, event: Event) -> None:
-        self.layout_view.timer()
-        self.layout_view.send_enter_event()
-        self.refresh()
+        # Only tell KLayout about the enter once the mouse actually does
+        # something, passing over the image shouldn't cause a redraw.
+        self._needs_enter = True
 
     def on_mouse_leave(self, event: Event) -> None:
-        self.layout_view.timer()
-        self.layout_view.send_leave_event()
-        self.refresh()
+        self._needs_enter = False
+        # The mouseup of a drag can happen outside of the image.
+        self._press_pos = None
+        if self._interacting:
+            self._set_interacting(False)
+            self.refresh()
+        if self._entered:
+            self._entered = False
+            self.layout_view.send_leave_event()
+            self.refresh()
+
+    def _send_pending_enter(self) -> None:
+        if self._needs_enter:
+            self._needs_enter = False
+            self._entered = True
+            self.layout_view.send_enter_event()
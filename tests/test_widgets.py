@@ -0,0 +1,221 @@
+import asyncio
+from itertools import product
+from typing import Any
+from unittest.mock import MagicMock
+
+import pytest
+
+import kfactory as kf
+
+pytest.importorskip("ipyevents")
+pytest.importorskip("ipytree")
+pytest.importorskip("ipywidgets")
+
+from kfactory.widgets.interactive import LayoutWidget  # noqa: E402
+
+
+@pytest.fixture
+def layout_view(monkeypatch: pytest.MonkeyPatch) -> MagicMock:
+    """Mocked LayoutView used by the LayoutWidgets of a test."""
+    view = MagicMock()
+    view.mode_names.return_value = ["select"]
+    # every screenshot is a new frame
+    view.get_screenshot_pixels.side_effect = lambda: MagicMock(
+        **{"to_png_data.return_value": b""}
+    )
+    monkeypatch.setattr(kf.lay, "LayoutView", lambda: view)
+    return view
+
+
+def test_refresh_coalesce(layout_view: MagicMock) -> None:
+    async def run() -> None:
+        lw = LayoutWidget(kf.KCell())
+        await asyncio.sleep(0.1)
+        layout_view.get_screenshot_pixels.reset_mock()
+
+        for _ in range(5):
+            lw.refresh()
+        assert layout_view.get_screenshot_pixels.call_count == 1
+        await asyncio.sleep(0.1)
+        # only one trailing frame for the burst
+        assert layout_view.get_screenshot_pixels.call_count == 2
+        assert lw._refresh_timer is None
+        assert not lw._refresh_pending
+
+    asyncio.run(run())
+
+
+def test_refresh_reentrant(layout_view: MagicMock) -> None:
+    async def run() -> None:
+        lw = LayoutWidget(kf.KCell())
+        await asyncio.sleep(0.1)
+        layout_view.get_screenshot_pixels.reset_mock()
+        calls = 0
+
+        def timer() -> None:
+            # the LayoutView calls `on_image_updated_event` from `timer()`
+            nonlocal calls
+            calls += 1
+            if calls == 1:
+                lw.refresh()
+
+        layout_view.timer.side_effect = timer
+        lw.refresh()
+        assert layout_view.get_screenshot_pixels.call_count == 1
+        assert lw._refresh_pending
+        await asyncio.sleep(0.1)
+        assert layout_view.get_screenshot_pixels.call_count == 2
+        assert lw._refresh_timer is None
+
+    asyncio.run(run())
+
+
+def test_refresh_no_loop(layout_view: MagicMock) -> None:
+    lw = LayoutWidget(kf.KCell())
+    layout_view.get_screenshot_pixels.reset_mock()
+    lw.refresh()
+    lw.refresh()
+    assert layout_view.get_screenshot_pixels.call_count == 2
+    assert lw._refresh_timer is None
+
+
+def wheel_event(delta_y: float) -> dict[str, float | bool]:
+    return {
+        "deltaY": delta_y,
+        "relativeX": 100,
+        "relativeY": 50,
+        "shiftKey": False,
+        "altKey": False,
+        "ctrlKey": False,
+        "buttons": 0,
+    }
+
+
+def test_wheel_burst(layout_view: MagicMock) -> None:
+    async def run() -> None:
+        lw = LayoutWidget(kf.KCell())
+        for delta_y in (10, 20, 30):
+            lw.on_scroll(wheel_event(delta_y))
+        layout_view.send_wheel_event.assert_not_called()
+        await asyncio.sleep(0.2)
+        layout_view.send_wheel_event.assert_called_once_with(
+            -60, False, kf.kdb.DPoint(100, 50), 0
+        )
+        assert lw._wheel_timer is None
+        assert lw._wheel_accum == 0
+
+    asyncio.run(run())
+
+
+def test_wheel_no_loop(layout_view: MagicMock) -> None:
+    lw = LayoutWidget(kf.KCell())
+    lw.on_scroll(wheel_event(10))
+    lw.on_scroll(wheel_event(20))
+    assert layout_view.send_wheel_event.call_count == 2
+    assert lw._wheel_timer is None
+
+
+def test_modifier_buttons(layout_view: MagicMock) -> None:
+    lw = LayoutWidget(kf.KCell())
+    bs = kf.lay.ButtonState
+    for shift, alt, ctrl, mouse_buttons in product(
+        (False, True), (False, True), (False, True), range(8)
+    ):
+        buttons = 0
+        if shift:
+            buttons |= bs.ShiftKey
+        if alt:
+            buttons |= bs.AltKey
+        if ctrl:
+            buttons |= bs.ControlKey
+        if mouse_buttons & 1:
+            buttons |= bs.LeftButton
+        if mouse_buttons & 2:
+            buttons |= bs.RightButton
+        if mouse_buttons & 4:
+            buttons |= bs.MidButton
+        event = {
+            "shiftKey": shift,
+            "altKey": alt,
+            "ctrlKey": ctrl,
+            # buttons above the middle one are ignored
+            "buttons": mouse_buttons | 8,
+        }
+        assert lw._get_modifier_buttons(event) == buttons
+
+
+def mouse_event(event: str, x: float, y: float, buttons: int) -> dict[str, Any]:
+    return {
+        "event": event,
+        "relativeX": x,
+        "relativeY": y,
+        "shiftKey": False,
+        "altKey": False,
+        "ctrlKey": False,
+        "buttons": buttons,
+    }
+
+
+def test_view_point(layout_view: MagicMock) -> None:
+    lw = LayoutWidget(kf.KCell())
+    assert lw._view_point(100, 50) == kf.kdb.DPoint(100, 50)
+    lw._set_interacting(True)
+    layout_view.resize.assert_called_with(400, 300)
+    assert lw._view_point(100, 50) == kf.kdb.DPoint(50, 25)
+    lw._set_interacting(False)
+    layout_view.resize.assert_called_with(800, 600)
+    assert lw._view_point(100, 50) == kf.kdb.DPoint(100, 50)
+
+
+def test_mouse_click(layout_view: MagicMock) -> None:
+    lw = LayoutWidget(kf.KCell())
+    layout_view.resize.reset_mock()
+    left = kf.lay.ButtonState.LeftButton
+
+    # moves below the drag threshold keep the full resolution
+    lw.on_mouse(mouse_event("mousedown", 370, 270, 1))
+    lw.on_mouse(mouse_event("mousemove", 371, 270, 1))
+    lw.on_mouse(mouse_event("mousemove", 375, 270, 1))
+    lw.on_mouse(mouse_event("mouseup", 375, 270, 0))
+
+    layout_view.resize.assert_not_called()
+    layout_view.send_mouse_press_event.assert_called_once_with(
+        kf.kdb.DPoint(370, 270), left
+    )
+    assert [c.args for c in layout_view.send_mouse_move_event.call_args_list] == [
+        (kf.kdb.DPoint(371, 270), left),
+        (kf.kdb.DPoint(375, 270), left),
+    ]
+    layout_view.send_mouse_release_event.assert_called_once_with(
+        kf.kdb.DPoint(375, 270), 0
+    )
+
+
+def test_mouse_drag(layout_view: MagicMock) -> None:
+    lw = LayoutWidget(kf.KCell())
+    layout_view.resize.reset_mock()
+    left = kf.lay.ButtonState.LeftButton
+
+    lw.on_mouse(mouse_event("mousedown", 200, 150, 1))
+    lw.on_mouse(mouse_event("mousemove", 203, 150, 1))
+    assert not lw._interacting
+    # the move starting the drag is sent at full resolution, the rest at half
+    lw.on_mouse(mouse_event("mousemove", 220, 150, 1))
+    assert lw._interacting
+    layout_view.resize.assert_called_once_with(400, 300)
+    lw.on_mouse(mouse_event("mousemove", 240, 160, 1))
+    lw.on_mouse(mouse_event("mouseup", 240, 160, 0))
+    assert not lw._interacting
+    layout_view.resize.assert_called_with(800, 600)
+
+    layout_view.send_mouse_press_event.assert_called_once_with(
+        kf.kdb.DPoint(200, 150), left
+    )
+    assert [c.args for c in layout_view.send_mouse_move_event.call_args_list] == [
+        (kf.kdb.DPoint(203, 150), left),
+        (kf.kdb.DPoint(220, 150), left),
+        (kf.kdb.DPoint(120, 80), left),
+    ]
+    layout_view.send_mouse_release_event.assert_called_once_with(
+        kf.kdb.DPoint(120, 80), 0
+    )